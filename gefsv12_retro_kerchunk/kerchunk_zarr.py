@@ -1,30 +1,78 @@
 import asyncio
 import base64
+import concurrent.futures
 import datetime
-import glob
+import functools
+import itertools
 import json
 import os
+import pickle
 import pkgutil
 import re
 from tempfile import TemporaryDirectory
 from typing import List, Optional, Union
 
 import fsspec
-import nest_asyncio
+import fsspec.asyn
 import numpy as np
+import orjson
 import pandas as pd
 import pytz
-import ujson
 from kerchunk.combine import MultiZarrToZarr # type: ignore
 
 from . import utils
 
 base_s3_reforecast = "s3://noaa-gefs-retrospective/GEFSv12/reforecast/"
+max_concurrent_requests = 16  # S3 read throughput plateaus around 16-32 parallel requests
+max_json_writers = 16
+idx_range_bytes = 8192  # Covers the records of a typical idx file in a single ranged GET
+base64_ref_prefix = "base64:"
+unix_epoch_ordinal = datetime.date(1970, 1, 1).toordinal()
+# Runs on fsspec's dedicated IO loop so the client, its connection pool and TLS sessions are created once
+# and shared by every pull in the process; s3fs closes the client when the interpreter exits
 fs_read = fsspec.filesystem(
-    "s3", anon=True, skip_instance_cache=True, asynchronous=True
+    "s3",
+    anon=True,
+    skip_instance_cache=True,
+    config_kwargs={"max_pool_connections": 2 * max_concurrent_requests},
 )
-fs_local = fsspec.filesystem("", skip_instance_cache=True, use_listings_cache=False)
-nest_asyncio.apply()
+
+
+@functools.lru_cache(maxsize=None)
+def _load_representative_json(representative_json_name: str) -> bytes:
+    """Parses a packaged representative JSON once and returns it pickled, which is cheaper to copy from"""
+    data_bytes = pkgutil.get_data(__name__, representative_json_name)
+    return pickle.dumps(json.loads(data_bytes.decode("utf-8")))
+
+
+def _idx_record(idx: bytes, line_ends: np.ndarray, record_num: int) -> List[str]:
+    """Splits a single record of an idx file into its ':' delimited fields"""
+    start = line_ends[record_num - 1] + 1 if record_num else 0
+    return idx[start : line_ends[record_num]].decode("ascii").split(":")
+
+
+def _init_datetime64(date_string: str) -> np.datetime64:
+    """Converts a YYYYMMDDHH init time to datetime64 arithmetically rather than parsing an ISO string"""
+    day = datetime.date(int(date_string[:4]), int(date_string[4:6]), int(date_string[6:8]))
+    seconds = (day.toordinal() - unix_epoch_ordinal) * 86400 + int(date_string[8:]) * 3600
+    return np.datetime64(seconds, "s")
+
+
+def _base64_ref(value) -> str:
+    """Encodes a value as an inlined kerchunk base64 ref"""
+    return base64_ref_prefix + base64.b64encode(value).decode("ascii")
+
+
+@functools.lru_cache(maxsize=None)
+def _step_timedelta(step: int) -> np.timedelta64:
+    """Forecast step as a timedelta; shared by every file pulled for the same forecast hour"""
+    return np.timedelta64(step, "h")
+
+
+@functools.lru_cache(maxsize=None)
+def _step_ref(step: int) -> str:
+    """Inlined base64 step ref; shared by every file pulled for the same forecast hour"""
+    return _base64_ref(_step_timedelta(step))
 
 
 class RetrospectivePull:
@@ -40,19 +88,24 @@ class RetrospectivePull:
         centered_date_range (int): Range of dates centered around the given date. Defaults to 10.
         forecast_horizon (str): Forecast horizon. Defaults to "Days:1-10".
         members (Union[None, str, List[str]]): List of members to pull. Defaults to ["c00", "p01", "p02", "p03", "p04"].
+        stream_json_files (bool): Write each JSON file as soon as its idx file arrives, overlapping downloads with
+            JSON generation. Defaults to True.
     Methods:
         date_to_glob_pattern(date: datetime.datetime) -> list:
             Ingests a single date and returns a list of month-day combinations.
         generate_reforecast_uris(glob_patterns):
             Generates URIs for reforecast data based on glob patterns.
         async work_coroutine():
-            Asynchronous coroutine to fetch data and file info concurrently.
+            Asynchronous coroutine to fetch idx files and the grib file sizes that are needed, optionally
+            writing JSON files as the downloads complete.
+        async grib_file_length(file_location, idx):
+            Reads the size of a grib file from the indicator section of its last message.
         open_rep_file():
-            Opens and reads the representative JSON file.
+            Returns a fresh copy of the representative JSON data, parsed once per process.
         generate_file(file, file_name):
             Generates a JSON file from the given data and saves it to the specified file name.
         generate_json_files():
-            Generates JSON files for the reforecast data.
+            Generates JSON files for the reforecast data that have not been written yet.
         generate_kerchunk(ds: bool = False):
             Generates kerchunk metadata and optionally returns an xarray dataset.
     """
@@ -69,13 +122,16 @@ class RetrospectivePull:
         centered_date_range: int = 10,
         forecast_horizon: str = "Days:1-10",
         members: Union[None, str, List[str]] = None,
+        stream_json_files: bool = True,
     ):
         if directory is None:
             self.td = TemporaryDirectory()
             self.directory = self.td.name
+        else:
+            self.directory = directory
         self.date = date
         self.fhour = fhour
-        self.message_num = self.fhour_to_message_num()
+        self.message_num = self.fhour_to_message_num(self.fhour)
         self.variable = variable
         self.representative_json_name = f"assets/representative_{self.variable}.json"
         self.representative_json_data = self.open_rep_file()
@@ -90,27 +146,37 @@ class RetrospectivePull:
             self.members = list(members)
         else:
             self.members = members
+        # Member codes are fixed per pull, so their encoded "number" refs are built once up front
+        self._number_refs = {
+            member: f"{chr(int(member[1:]))}\x00\x00\x00\x00\x00\x00\x00"
+            for member in self.members
+        }
+        self.stream_json_files = stream_json_files
         self.reforecast_urls = self.generate_reforecast_uris(self.glob_pattern)
-        self.idx_files, self.files_info = asyncio.run(self.work_coroutine())
-        self.file_sizes = [n["size"] for n in self.files_info]
-        self.files_metadata_dict = dict(zip(self.idx_files, self.file_sizes))
+        self.idx_files = {}
+        self.files_metadata_dict = {}
+        self._json_written = set()
+        self._written_files: List[str] = []
+        fsspec.asyn.sync(fs_read.loop, self.work_coroutine)
 
-    def fhour_to_message_num(self) -> int:
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def fhour_to_message_num(fhour: int) -> int:
         """Converts forecast hour to message number"""
-        assert self.fhour != 0, "No hour 0 forecast available"
-        assert self.fhour % 3 == 0, "Forecast hour must be divisible by 3"
-        message_num = ((self.fhour) // 3) - 1
+        assert fhour != 0, "No hour 0 forecast available"
+        assert fhour % 3 == 0, "Forecast hour must be divisible by 3"
+        message_num = (fhour // 3) - 1
         return message_num
 
     def date_to_glob_pattern(self, date: datetime.datetime) -> list:
         """Ingests a single date and returns a list of month-day combinations"""
-        datetime_min = date - datetime.timedelta(days=self.centered_date_range)
-        datetime_max = date + datetime.timedelta(days=self.centered_date_range)
-        datetime_range = pd.date_range(datetime_min, datetime_max, freq="D")
-        month_day_combinations = set(
-            zip(datetime_range.month, datetime_range.day)  # pylint: disable=no-member
+        days = (
+            date + datetime.timedelta(days=offset)
+            for offset in range(-self.centered_date_range, self.centered_date_range + 1)
         )
-        glob_patterns = [f"{month:02}{day:02}" for month, day in month_day_combinations]
+        # Encoded as month * 100 + day so duplicates (ranges over a year) drop out cheaply, in date order
+        month_day_combinations = dict.fromkeys(day.month * 100 + day.day for day in days)
+        glob_patterns = [f"{month_day:04d}" for month_day in month_day_combinations]
         return glob_patterns
 
     def generate_reforecast_uris(self, glob_patterns):
@@ -126,110 +192,147 @@ class RetrospectivePull:
             list of str: A list of URIs pointing to the reforecast data files.
         """
 
-        reforecast_patterns = [
-            f"{base_s3_reforecast}{year}/{year}" for year in range(2000, 2020)
-        ]
-        reforecast_patterns_w_days = [
-            f"{yearly_rf_patterns}{globs}00/"
-            for yearly_rf_patterns in reforecast_patterns
-            for globs in glob_patterns
-        ]
-        reforecast_patterns_w_members_horizon = [
-            f"{daily_rf_patterns}{member}/{self.forecast_horizon}/"
-            for daily_rf_patterns in reforecast_patterns_w_days
-            for member in self.members
-        ]
-        reforecast_patterns_w_members_horizon_variable = [
-            f"{subpath}{self.variable}_{subpath.split('/')[6]}_{subpath.split('/')[7]}.grib2.idx"
-            for subpath in reforecast_patterns_w_members_horizon
-        ]
-        return reforecast_patterns_w_members_horizon_variable
+        reforecast_uris = []
+        for year, globs, member in itertools.product(
+            range(2000, 2020), glob_patterns, self.members
+        ):
+            init_time = f"{year}{globs}00"
+            reforecast_uris.append(
+                f"{base_s3_reforecast}{year}/{init_time}/{member}/{self.forecast_horizon}/"
+                f"{self.variable}_{init_time}_{member}.grib2.idx"
+            )
+        return reforecast_uris
 
     async def work_coroutine(self):
-        session = await fs_read.set_session()  # Creates the client
+        await fs_read.set_session()  # Creates the client on first use, reused afterwards
+        self._request_semaphore = asyncio.Semaphore(max_concurrent_requests)
+
+        # JSON generation is CPU work, so it runs off the event loop while downloads continue
+        json_queue = asyncio.Queue()
+        json_writer = (
+            asyncio.create_task(self._json_writer(json_queue))
+            if self.stream_json_files
+            else None
+        )
+        # Fetches data concurrently, capped so the connection pool isn't flooded
+        fetches = [
+            asyncio.ensure_future(self._fetch_idx(url)) for url in self.reforecast_urls
+        ]
+        try:
+            for fetch in asyncio.as_completed(fetches):
+                file_location, idx, file_length = await fetch
+                self.idx_files[file_location] = idx
+                if file_length is not None:
+                    self.files_metadata_dict[file_location] = file_length
+                if json_writer is not None:
+                    if json_writer.done():
+                        # Surfaces a failed write now rather than after every fetch has finished
+                        json_writer.result()
+                    json_queue.put_nowait(file_location)
+        except BaseException:
+            # The IO loop outlives this pull, so don't leave its tasks running on it
+            for task in [*fetches, json_writer]:
+                if task is not None:
+                    task.cancel()
+            raise
+        if json_writer is not None:
+            json_queue.put_nowait(None)
+            await json_writer
+
+    async def _fetch_idx(self, url):
+        file_location = fs_read._strip_protocol(url)
+        idx = await self._bounded_get(url, start=0, end=idx_range_bytes)
+        if len(idx) == idx_range_bytes:
+            if idx.count(b"\n") < self.message_num + 2:
+                # The requested record or the one bounding it may be cut off, so fetch it all
+                idx = await self._bounded_get(url)
+            else:
+                idx = idx[: idx.rfind(b"\n") + 1]  # Drops the partial trailing record
+        # Only the last message of a grib file needs the file size to bound its byte range,
+        # so skip a HEAD per file and only size the files where that message is requested
+        file_length = None
+        if self.message_num == idx.count(b"\n") - 1:
+            file_length = await self.grib_file_length(file_location, idx)
+        return file_location, idx, file_length
 
-        # Define tasks for fetching data and getting file info concurrently
-        data_task = fs_read._cat(self.reforecast_urls)  # Fetches data concurrently
-        info_tasks = [
-            fs_read._info(path) for path in [rf[:-4] for rf in self.reforecast_urls]
-        ]  # Gets info concurrently
-        file_info = await asyncio.gather(*info_tasks)  # Runs all info tasks in parallel
+    async def _json_writer(self, json_queue):
+        loop = asyncio.get_running_loop()
+        while (file_location := await json_queue.get()) is not None:
+            await loop.run_in_executor(None, self._build_and_write, file_location)
 
-        out = await data_task  # Await the data task
-        await session.close()  # Explicit destructor for cleanup
+    async def grib_file_length(self, file_location, idx):
+        """Reads the size of a grib file from the indicator section of its last message"""
+        line_ends = np.flatnonzero(np.frombuffer(idx, dtype=np.uint8) == ord("\n"))
+        last_offset = int(_idx_record(idx, line_ends, line_ends.size - 1)[1])
+        indicator_section = await self._bounded_get(
+            f"s3://{file_location[:-4]}", start=last_offset, end=last_offset + 16
+        )
+        # A wrong offset or a non GRIB2 object would otherwise yield a bogus message range
+        if indicator_section[:4] != b"GRIB" or indicator_section[7] != 2:
+            raise ValueError(
+                f"No GRIB2 message at byte {last_offset} of s3://{file_location[:-4]}"
+            )
+        # Octets 9-16 of a GRIB2 indicator section hold the total message length
+        return last_offset + int.from_bytes(indicator_section[8:16], "big")
 
-        return out, file_info
+    async def _bounded_get(self, path, start=None, end=None):
+        async with self._request_semaphore:
+            return await fs_read._cat_file(path, start=start, end=end)
 
     def open_rep_file(self):
-        data_bytes = pkgutil.get_data(__name__, self.representative_json_name)
-        data_str = data_bytes.decode("utf-8")
-        representative_json_data = json.loads(data_str)
-        return representative_json_data
+        return pickle.loads(_load_representative_json(self.representative_json_name))
 
     def generate_file(self, file, file_name):
         outf = os.path.join(self.directory, file_name)
-        with fs_local.open(outf, "w") as f:
-            f.write(ujson.dumps(file, reject_bytes=False))
+        with open(outf, "wb", buffering=65536) as f:
+            f.write(orjson.dumps(file, option=orjson.OPT_SERIALIZE_NUMPY))
+        self._written_files.append(outf)
 
     def generate_json_files(self):
-        file_locations = list(self.idx_files.keys())
+        file_locations = [
+            file_location
+            for file_location in self.idx_files
+            if file_location not in self._json_written
+        ]
+        # Each file is built from its own template copy, so writes can run in parallel
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_json_writers) as executor:
+            list(executor.map(self._build_and_write, file_locations))
+
+    def _build_and_write(self, file_location):
+        idx = self.idx_files[file_location]
+        # Record boundaries are located on the raw bytes so only the records used get decoded
+        line_ends = np.flatnonzero(np.frombuffer(idx, dtype=np.uint8) == ord("\n"))
+        i = self.message_num
+        if i >= line_ends.size:
+            return
+        record = _idx_record(idx, line_ends, i)
+        message_offset = int(record[1])
+        if i + 1 < line_ends.size:
+            message_end = int(_idx_record(idx, line_ends, i + 1)[1])
+        else:
+            # The last message runs to the end of the grib file, which is only sized when needed
+            message_end = self.files_metadata_dict[file_location]
+        npdt64date = _init_datetime64(file_location.split("_")[2])
         data_to_replace = self.open_rep_file()
-        for file_location in file_locations:
-            message_nums = [
-                n.split(":")[1]
-                for n in self.idx_files[file_location].decode("utf-8").split("\n")[:-1]
-            ]
-            message_length = self.files_metadata_dict[file_location]
-            date_string = file_location.split("_")[2]
-            formatted_date = f"{date_string[:4]}-{date_string[4:6]}-{date_string[6:8]}T{date_string[8:]}"
-            npdt64date = np.datetime64(formatted_date, "s")
-            for i, n in enumerate(message_nums):
-                if i == self.message_num:
-                    step_str = (
-                        self.idx_files[file_location]
-                        .decode("utf-8")
-                        .split("\n")[i]
-                        .split(":")[5]
-                    )
-
-                    step = int("".join(x for x in step_str if x.isdigit()))
-                    nptd64step = npdt64date + np.timedelta64(step, "h")
-                    if i == 0:
-                        message_range = ["{{u}}", 0, int(message_nums[1])]
-                    elif i == len(message_nums) - 1:
-                        message_range = [
-                            "{{u}}",
-                            int(message_nums[i]),
-                            int(message_length - int(message_nums[i])),
-                        ]
-                    else:
-                        message_range = [
-                            "{{u}}",
-                            int(message_nums[i]),
-                            int(int(message_nums[i + 1]) - int(message_nums[i])),
-                        ]
-                    data_to_replace["refs"]["msl/0.0"] = message_range
-                    data_to_replace["templates"] = {"u": f"s3://{file_location[:-4]}"}
-                    data_to_replace["refs"]["time/0"] = b"base64:" + base64.b64encode(
-                        npdt64date
-                    )
-                    data_to_replace["refs"]["valid_time/0"] = (
-                        b"base64:" + base64.b64encode(nptd64step)
-                    )
-                    data_to_replace["refs"]["step/0"] = b"base64:" + base64.b64encode(
-                        np.timedelta64(step, "h")
-                    )
-                    number_value = int(file_location.split('/')[5][1:])
-                    data_to_replace["refs"]["number/0"] = f"{chr(number_value)}\x00\x00\x00\x00\x00\x00\x00"
-                    self.generate_file(
-                        data_to_replace,
-                        f"{file_location.split('/')[7].split('.')[0]}_{i:02}.json",
-                    )
+        step = int(record[5].split(maxsplit=1)[0])  # Instantaneous fields read e.g. "6 hour fcst"
+        nptd64step = npdt64date + _step_timedelta(step)
+        message_range = ["{{u}}", message_offset, message_end - message_offset]
+        data_to_replace["refs"]["msl/0.0"] = message_range
+        data_to_replace["templates"] = {"u": f"s3://{file_location[:-4]}"}
+        # orjson rejects bytes, so the inlined base64 refs are kept as str
+        data_to_replace["refs"]["time/0"] = _base64_ref(npdt64date)
+        data_to_replace["refs"]["valid_time/0"] = _base64_ref(nptd64step)
+        data_to_replace["refs"]["step/0"] = _step_ref(step)
+        data_to_replace["refs"]["number/0"] = self._number_refs[file_location.split("/")[5]]
+        self.generate_file(
+            data_to_replace,
+            f"{file_location.split('/')[7].split('.')[0]}_{i:02}.json",
+        )
+        self._json_written.add(file_location)
 
     def generate_kerchunk(self, ds: bool = False, kill_tmp_dir: bool = True):
-        file_list = glob.glob(f"{self.directory}/*")
         mzz = MultiZarrToZarr(
-            file_list,
+            self._written_files,
             concat_dims=["number", "step", "valid_time"],
             identical_dims=["latitude", "longitude"],
         )
@@ -0,0 +1,187 @@
+import base64
+import datetime
+import json
+
+import fsspec.asyn
+import numpy as np
+import pytest
+
+from gefsv12_retro_kerchunk import kerchunk_zarr
+
+NUM_MESSAGES = 80  # Days:1-10 holds one 3-hourly message per forecast hour from 3 to 240
+
+
+class FakeS3:
+    """Serves synthetic idx files and the GRIB2 indicator sections they point at"""
+
+    _s3 = None
+
+    def __init__(self, record_padding=0, edition=2):
+        self.record_padding = record_padding
+        self.edition = edition
+        self.message_lengths = [900_000 + i for i in range(NUM_MESSAGES)]
+        self.message_offsets = np.cumsum([0] + self.message_lengths[:-1]).tolist()
+        self.requests = []
+
+    @property
+    def loop(self):
+        return fsspec.asyn.get_loop()
+
+    async def set_session(self):
+        return self._s3
+
+    def _strip_protocol(self, path):
+        return path[len("s3://"):] if path.startswith("s3://") else path
+
+    def idx(self, path):
+        date_string = path.split("_")[2]
+        return "".join(
+            f"{i + 1}:{offset}:d={date_string}:PRMSL:mean sea level:{(i + 1) * 3} hour fcst:"
+            f"ENS=low-res ctl{'x' * self.record_padding}\n"
+            for i, offset in enumerate(self.message_offsets)
+        ).encode("ascii")
+
+    async def _cat_file(self, path, start=None, end=None):
+        self.requests.append((path, start, end))
+        if path.endswith(".idx"):
+            return self.idx(path)[start:end]
+        length = self.message_lengths[self.message_offsets.index(start)]
+        indicator_section = b"GRIB\x00\x00\x00" + bytes([self.edition]) + length.to_bytes(8, "big")
+        return indicator_section[: end - start]
+
+
+def make_pull(monkeypatch, tmp_path, fake_s3, fhour, **kwargs):
+    monkeypatch.setattr(kerchunk_zarr, "fs_read", fake_s3)
+    return kerchunk_zarr.RetrospectivePull(
+        date=datetime.datetime(2020, 1, 15),
+        fhour=fhour,
+        directory=str(tmp_path),
+        centered_date_range=0,
+        members=["c00"],
+        **kwargs,
+    )
+
+
+def read_refs(pull):
+    refs = []
+    for outf in pull._written_files:
+        with open(outf) as f:
+            refs.append(json.load(f))
+    return refs
+
+
+@pytest.mark.parametrize(
+    "record_padding, fhour, full_idx_gets",
+    [
+        # Whole idx files fit in the ranged GET
+        (0, 3, 0),
+        (0, 120, 0),
+        (0, 237, 0),
+        (0, 240, 0),
+        # ~150 byte records, so the ranged GET holds the first 52 complete records
+        (80, 3, 0),
+        (80, 120, 0),
+        (80, 153, 0),  # The bounding record is the last complete one
+        (80, 156, 20),  # The requested record is the last complete one
+        (80, 237, 20),
+        (80, 240, 20),
+    ],
+)
+def test_message_ranges(monkeypatch, tmp_path, record_padding, fhour, full_idx_gets):
+    fake_s3 = FakeS3(record_padding)
+    pull = make_pull(monkeypatch, tmp_path, fake_s3, fhour)
+    message_num = fhour // 3 - 1
+
+    idx_size = len(fake_s3.idx("pres_msl_2000011500_c00.grib2.idx"))
+    assert (idx_size > kerchunk_zarr.idx_range_bytes) == bool(record_padding)
+    idx_requests = [r for r in fake_s3.requests if r[0].endswith(".idx")]
+    assert len(idx_requests) == 20 + full_idx_gets
+    assert sum(start is None for _, start, _ in idx_requests) == full_idx_gets
+    for idx in pull.idx_files.values():
+        assert idx.endswith(b"\n")  # Any partial trailing record was dropped
+
+    grib_requests = [r for r in fake_s3.requests if r[0].endswith(".grib2")]
+    assert len(grib_requests) == (20 if message_num == NUM_MESSAGES - 1 else 0)
+
+    refs = read_refs(pull)
+    assert len(refs) == 20
+    for ref in refs:
+        assert ref["refs"]["msl/0.0"] == [
+            "{{u}}",
+            fake_s3.message_offsets[message_num],
+            fake_s3.message_lengths[message_num],
+        ]
+        step = base64.b64decode(ref["refs"]["step/0"][len("base64:"):])
+        assert np.frombuffer(step, dtype="<i8")[0] == fhour
+        assert ref["templates"]["u"].endswith(".grib2")
+
+
+def test_truncated_idx_drops_partial_record(monkeypatch, tmp_path):
+    pull = make_pull(monkeypatch, tmp_path, FakeS3(record_padding=80), fhour=120)
+
+    for idx in pull.idx_files.values():
+        assert len(idx) < kerchunk_zarr.idx_range_bytes
+        assert idx.count(b"\n") == 52
+
+
+def test_generate_json_files_matches_streaming(monkeypatch, tmp_path):
+    (tmp_path / "streamed").mkdir()
+    (tmp_path / "deferred").mkdir()
+    streamed = make_pull(monkeypatch, tmp_path / "streamed", FakeS3(), fhour=240)
+    deferred = make_pull(
+        monkeypatch, tmp_path / "deferred", FakeS3(), fhour=240, stream_json_files=False
+    )
+    assert deferred._written_files == []
+
+    deferred.generate_json_files()
+
+    def by_template(refs):
+        return sorted(refs, key=lambda ref: ref["templates"]["u"])
+
+    assert by_template(read_refs(deferred)) == by_template(read_refs(streamed))
+
+
+def test_last_message_requires_grib2_indicator(monkeypatch, tmp_path):
+    with pytest.raises(ValueError, match="No GRIB2 message"):
+        make_pull(monkeypatch, tmp_path, FakeS3(edition=1), fhour=240)
+
+
+def glob_patterns(date, centered_date_range):
+    pull = object.__new__(kerchunk_zarr.RetrospectivePull)
+    pull.centered_date_range = centered_date_range
+    return pull.date_to_glob_pattern(date)
+
+
+def test_date_to_glob_pattern_spans_year_end_in_order():
+    assert glob_patterns(datetime.datetime(2024, 1, 1), 2) == [
+        "1230",
+        "1231",
+        "0101",
+        "0102",
+        "0103",
+    ]
+
+
+def test_date_to_glob_pattern_keeps_leap_day():
+    assert glob_patterns(datetime.datetime(2024, 3, 1), 1) == ["0229", "0301", "0302"]
+    assert glob_patterns(datetime.datetime(2023, 3, 1), 1) == ["0228", "0301", "0302"]
+
+
+def test_date_to_glob_pattern_dedupes_windows_over_a_year():
+    patterns = glob_patterns(datetime.datetime(2023, 7, 1), 200)
+    assert len(patterns) == len(set(patterns)) == 365
+    assert patterns[0] == "1213"
+
+
+@pytest.mark.parametrize(
+    "date_string", ["2000010100", "2016022918", "2019123112", "1969123118"]
+)
+def test_init_datetime64_matches_iso_parse(date_string):
+    expected = np.datetime64(
+        f"{date_string[:4]}-{date_string[4:6]}-{date_string[6:8]}T{date_string[8:]}", "s"
+    )
+
+    npdt64date = kerchunk_zarr._init_datetime64(date_string)
+
+    assert npdt64date.dtype == expected.dtype
+    assert npdt64date.tobytes() == expected.tobytes()